@@ -0,0 +1,461 @@
+# query helpers for reading the partitioned TER datasets back from s3
+#
+# the ingestion scripts write one object per protein and chromosome:
+#   TER/<dataset>/chr{N}/<protein>.parquet
+# scan_ter turns a query into the smallest set of objects and row groups to read.
+# footers are cached per object, row groups are pruned using the column
+# statistics written by polars, and only the byte ranges of the surviving
+# column chunks are fetched with ranged GETs. nothing is read until the
+# returned LazyFrame is collected.
+import bisect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import polars as pl
+import pyarrow.parquet as pq
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from polars.io.plugins import register_io_source
+
+from function import get_secret
+
+# enough to hold the footer of a per-chromosome partition in a single GET
+FOOTER_PREFETCH = 64 * 1024
+# column chunks closer than this are fetched in one request
+COALESCE_GAP = 1024 * 1024
+# serialized footer bytes kept in memory, least recently used are dropped first.
+# a chr1 partition footer is ~10KB, so this holds every protein of a dataset
+# for several chromosomes; pass footer_cache_bytes to scan_ter for whole-genome scans
+FOOTER_CACHE_BYTES = 256 * 1024 * 1024
+MAX_WORKERS = 64
+CHROMOSOMES = list(range(1, 24))
+
+# (bucket, key) -> (size, etag, metadata)
+_footer_cache = OrderedDict()
+_footer_cache_bytes = 0
+_footer_lock = threading.Lock()
+
+
+def get_s3_client(max_workers=MAX_WORKERS):
+    secret = get_secret()
+    config = Config(max_pool_connections=max_workers)
+    s3_client = boto3.client('s3', aws_access_key_id=secret['s3_access_key_secret_name'], aws_secret_access_key=secret['s3_secret_key_secret_name'], config=config)
+    return s3_client, secret['s3_bucket_name_secret_name']
+
+
+def clear_footer_cache():
+    global _footer_cache_bytes
+    with _footer_lock:
+        _footer_cache.clear()
+        _footer_cache_bytes = 0
+
+
+def _pop_footer(cache_key):
+    # caller holds _footer_lock
+    global _footer_cache_bytes
+    footer = _footer_cache.pop(cache_key, None)
+    if footer is not None:
+        _footer_cache_bytes -= footer[2].serialized_size
+
+
+def evict_footer(bucket, key):
+    with _footer_lock:
+        _pop_footer((bucket, key))
+
+
+class S3RangeFile:
+    """Read-only, seekable view of an s3 object backed by ranged GETs."""
+
+    def __init__(self, s3_client, bucket, key, size=None, etag=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.closed = False
+        self._pos = 0
+        # start offset -> bytes already fetched
+        self._chunks = {}
+        if size is None:
+            # a suffix range returns the footer and tells us the object size
+            response = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes=-{FOOTER_PREFETCH}')
+            body = response['Body'].read()
+            self.etag = response.get('ETag')
+            if 'ContentRange' in response:
+                size = int(response['ContentRange'].split('/')[-1])
+            else:
+                # some stand-ins answer a suffix range on an empty object with the whole body
+                size = len(body)
+            if body:
+                self._chunks[size - len(body)] = body
+        self.size = size
+
+    def _get_range(self, start, end):
+        # pin every read to the version the footer came from
+        kwargs = {'IfMatch': self.etag} if self.etag else {}
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end - 1}', **kwargs)
+        return response['Body'].read()
+
+    def _find(self, start, end):
+        for chunk_start, data in self._chunks.items():
+            if chunk_start <= start and end <= chunk_start + len(data):
+                return data[start - chunk_start:end - chunk_start]
+        return None
+
+    def prefetch(self, ranges, max_gap=COALESCE_GAP):
+        """Fetch byte ranges up front, merging ranges that are close together."""
+        for start, end in _coalesce(ranges, max_gap):
+            if self._find(start, end) is None:
+                self._chunks[start] = self._get_range(start, end)
+
+    def read(self, n=-1):
+        start = self._pos
+        end = self.size if n is None or n < 0 else min(self.size, start + n)
+        if start >= end:
+            return b''
+        data = self._find(start, end)
+        if data is None:
+            data = self._get_range(start, end)
+        self._pos = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        elif whence == 2:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f'invalid whence: {whence}')
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        self._chunks.clear()
+
+
+def _coalesce(ranges, max_gap):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def _is_missing(e):
+    return e.response['Error']['Code'] in ('NoSuchKey', '404')
+
+
+def _is_empty(e):
+    # s3 rejects a suffix range on a zero-byte object
+    return e.response['Error']['Code'] in ('InvalidRange', '416')
+
+
+def _is_stale(e):
+    return e.response['Error']['Code'] in ('PreconditionFailed', '412')
+
+
+def get_footer(s3_client, bucket, key, etag=None, cache_bytes=None):
+    """Return ((size, etag, metadata), source) for an object, reading the footer only on first use.
+
+    A cached footer is only used if it matches etag, when one is given (e.g. from a listing).
+    cache_bytes overrides FOOTER_CACHE_BYTES as the bound on the cache.
+    The footer is None for an empty object. source is the file the footer was just read
+    from, or None on a cache hit.
+    """
+    cache_key = (bucket, key)
+    with _footer_lock:
+        cached = _footer_cache.get(cache_key)
+        if cached is not None and (etag is None or cached[1] == etag):
+            _footer_cache.move_to_end(cache_key)
+            return cached, None
+    source = S3RangeFile(s3_client, bucket, key)
+    if source.size == 0:
+        source.close()
+        return None, None
+    metadata = pq.read_metadata(source)
+    footer = (source.size, source.etag, metadata)
+    limit = FOOTER_CACHE_BYTES if cache_bytes is None else cache_bytes
+    global _footer_cache_bytes
+    with _footer_lock:
+        _pop_footer(cache_key)
+        _footer_cache[cache_key] = footer
+        _footer_cache_bytes += metadata.serialized_size
+        while _footer_cache_bytes > limit and _footer_cache:
+            _pop_footer(next(iter(_footer_cache)))
+    # hand the open file back so the footer GET can be reused for small objects
+    return footer, source
+
+
+def _column_stats(row_group, index):
+    if index is None:
+        return None
+    stats = row_group.column(index).statistics
+    if stats is None or not stats.has_min_max:
+        return None
+    return stats.min, stats.max
+
+
+def select_row_groups(metadata, start=None, end=None, snps=None, pval_threshold=None):
+    """Return the indices of row groups whose statistics may match the query."""
+    names = [metadata.schema.column(j).name for j in range(metadata.num_columns)]
+    index = {name: j for j, name in enumerate(names)}
+    selected = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        if row_group.num_rows == 0:
+            continue
+        if start is not None or end is not None:
+            stats = _column_stats(row_group, index.get('pos'))
+            if stats is not None:
+                if end is not None and stats[0] > end:
+                    continue
+                if start is not None and stats[1] < start:
+                    continue
+        if pval_threshold is not None:
+            stats = _column_stats(row_group, index.get('pval'))
+            if stats is not None and stats[0] >= pval_threshold:
+                continue
+        if snps is not None:
+            stats = _column_stats(row_group, index.get('SNP'))
+            if stats is not None:
+                # snps is sorted, so check whether any falls within [min, max]
+                k = bisect.bisect_left(snps, stats[0])
+                if k == len(snps) or snps[k] > stats[1]:
+                    continue
+        selected.append(i)
+    return selected
+
+
+def _column_chunk_ranges(metadata, row_groups, columns):
+    names = [metadata.schema.column(j).name for j in range(metadata.num_columns)]
+    indices = [j for j, name in enumerate(names) if columns is None or name in columns]
+    ranges = []
+    for i in row_groups:
+        row_group = metadata.row_group(i)
+        for j in indices:
+            column = row_group.column(j)
+            offset = column.data_page_offset
+            if column.has_dictionary_page and column.dictionary_page_offset is not None:
+                offset = min(offset, column.dictionary_page_offset)
+            ranges.append((offset, offset + column.total_compressed_size))
+    return ranges
+
+
+def _query_filter(start=None, end=None, snps=None, pval_threshold=None):
+    predicates = []
+    if start is not None:
+        predicates.append(pl.col('pos') >= start)
+    if end is not None:
+        predicates.append(pl.col('pos') <= end)
+    if snps is not None:
+        predicates.append(pl.col('SNP').is_in(snps))
+    if pval_threshold is not None:
+        predicates.append(pl.col('pval') < pval_threshold)
+    if not predicates:
+        return None
+    predicate = predicates[0]
+    for p in predicates[1:]:
+        predicate = predicate & p
+    return predicate
+
+
+def _empty_frame(metadata, columns=None):
+    df = pl.from_arrow(metadata.schema.to_arrow_schema().empty_table())
+    return df.select(columns) if columns is not None else df
+
+
+def _read_object(s3_client, bucket, key, etag, cache_bytes, columns, start, end, snps, pval_threshold):
+    footer, source = get_footer(s3_client, bucket, key, etag, cache_bytes)
+    if footer is None:
+        return None
+    size, footer_etag, metadata = footer
+    row_groups = select_row_groups(metadata, start, end, snps, pval_threshold)
+    if not row_groups:
+        if source is not None:
+            source.close()
+        elif etag is None and footer_etag:
+            # nothing will be fetched to catch a rewrite, so check the cached footer is current
+            s3_client.head_object(Bucket=bucket, Key=key, IfMatch=footer_etag)
+        return _empty_frame(metadata, columns)
+
+    read_columns = None
+    if columns is not None:
+        filter_columns = []
+        if start is not None or end is not None:
+            filter_columns.append('pos')
+        if snps is not None:
+            filter_columns.append('SNP')
+        if pval_threshold is not None:
+            filter_columns.append('pval')
+        read_columns = list(dict.fromkeys(list(columns) + filter_columns))
+
+    if source is None:
+        source = S3RangeFile(s3_client, bucket, key, size=size, etag=footer_etag)
+    try:
+        source.prefetch(_column_chunk_ranges(metadata, row_groups, read_columns))
+        parquet_file = pq.ParquetFile(source, metadata=metadata, pre_buffer=False)
+        table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+    finally:
+        source.close()
+
+    df = pl.from_arrow(table)
+    predicate = _query_filter(start, end, snps, pval_threshold)
+    if predicate is not None:
+        df = df.filter(predicate)
+    if columns is not None:
+        df = df.select(columns)
+    return df
+
+
+def read_object(s3_client, bucket, key, columns=None, start=None, end=None, snps=None, pval_threshold=None, etag=None,
+                cache_bytes=None):
+    """Read the matching rows of a single partition, or None if the object is missing or empty.
+
+    Pass the object's etag when it is already known (e.g. from a listing) to validate a
+    cached footer without an extra request.
+    """
+    for attempt in range(2):
+        try:
+            return _read_object(s3_client, bucket, key, etag, cache_bytes, columns, start, end, snps, pval_threshold)
+        except ClientError as e:
+            evict_footer(bucket, key)
+            if _is_missing(e) or _is_empty(e):
+                return None
+            # a stale footer means the object was rewritten after it was cached, so read it again
+            if not _is_stale(e) or attempt == 1:
+                raise e
+
+
+def read_schema(s3_client, bucket, key, columns=None, etag=None, cache_bytes=None):
+    """Return the polars schema of a partition from its footer, or None if the object is missing or empty."""
+    try:
+        footer, source = get_footer(s3_client, bucket, key, etag, cache_bytes)
+    except ClientError as e:
+        if _is_missing(e) or _is_empty(e):
+            return None
+        raise e
+    if source is not None:
+        source.close()
+    if footer is None:
+        return None
+    return _empty_frame(footer[2], columns).schema
+
+
+def list_partition_keys(s3_client, bucket, dataset, chrom):
+    """List (key, etag) for every protein object in one chromosome partition of a dataset."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    # trailing slash so chr1 does not also match chr10-chr19
+    page_iterator = paginator.paginate(Bucket=bucket, Prefix=f'TER/{dataset}/chr{chrom}/')
+    return [
+        (content['Key'], content['ETag'])
+        for page in page_iterator
+        for content in page.get('Contents', [])
+        if content['Key'].endswith('.parquet')
+    ]
+
+
+def scan_ter(dataset, chrom=None, start=None, end=None, snps=None, proteins=None, pval_threshold=None,
+             columns=None, s3_client=None, bucket_name=None, max_workers=MAX_WORKERS, footer_cache_bytes=None):
+    """Lazily query a partitioned TER dataset and return the matching rows as a polars LazyFrame.
+
+    chrom may be a single chromosome or a list, and defaults to all of them.
+    start/end bound pos (inclusive), snps restricts SNP, pval_threshold keeps pval < threshold.
+    When proteins is given the keys are built directly instead of listing the bucket.
+    Pass s3_client and bucket_name to query a different endpoint, e.g. a local s3 stand-in;
+    max_workers is capped to that client's max_pool_connections.
+    footer_cache_bytes overrides FOOTER_CACHE_BYTES, e.g. to keep every footer of a
+    whole-genome scan.
+    Listing and reading happen on every collect, and any later select/filter on the frame
+    is applied to each object as it is read.
+    """
+    if s3_client is None:
+        s3_client, default_bucket = get_s3_client(max_workers)
+        bucket_name = bucket_name or default_bucket
+    else:
+        # threads beyond the client's connection pool would only queue for a connection
+        max_workers = min(max_workers, s3_client.meta.config.max_pool_connections)
+    if chrom is None:
+        chroms = CHROMOSOMES
+    elif isinstance(chrom, (list, tuple, set)):
+        chroms = list(chrom)
+    else:
+        chroms = [chrom]
+    if snps is not None:
+        snps = sorted(set(snps))
+    if columns is not None:
+        columns = list(columns)
+
+    # the schema is resolved once, but keys are listed again on every collect so new
+    # and rewritten partitions are picked up. etags are only known when listing;
+    # built keys are validated as they are read
+    state = {}
+
+    def list_keys():
+        if proteins is not None:
+            keys = dict.fromkeys(f'TER/{dataset}/chr{c}/{protein}.parquet' for c in chroms for protein in proteins)
+            return [(key, None) for key in keys]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chroms))) as executor:
+            listings = executor.map(lambda c: list_partition_keys(s3_client, bucket_name, dataset, c), chroms)
+            return [key for listing in listings for key in listing]
+
+    def resolve_schema():
+        if 'schema' not in state:
+            # the first readable footer gives the schema; with no objects at all it is empty
+            state['schema'] = pl.Schema()
+            for key, etag in list_keys():
+                schema = read_schema(s3_client, bucket_name, key, columns, etag, footer_cache_bytes)
+                if schema is not None:
+                    state['schema'] = schema
+                    break
+        return state['schema']
+
+    def source(with_columns, predicate, n_rows, batch_size):
+        schema = resolve_schema()
+        read_columns = columns
+        if with_columns is not None:
+            read_columns = list(with_columns)
+            if predicate is not None:
+                read_columns += [c for c in predicate.meta.root_names() if c not in read_columns]
+
+        def read(key_etag):
+            key, etag = key_etag
+            return read_object(s3_client, bucket_name, key, read_columns, start, end, snps, pval_threshold, etag, footer_cache_bytes)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for df in executor.map(read, list_keys()):
+                if df is None or df.height == 0:
+                    continue
+                df = df.cast({name: schema[name] for name in df.columns})
+                if predicate is not None:
+                    df = df.filter(predicate)
+                if with_columns is not None:
+                    df = df.select(with_columns)
+                if n_rows is not None:
+                    df = df.head(n_rows)
+                    n_rows -= df.height
+                if df.height:
+                    yield df
+                if n_rows == 0:
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return register_io_source(source, schema=resolve_schema)
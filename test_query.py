@@ -0,0 +1,198 @@
+# tests for query.py against a moto s3 stand-in
+from io import BytesIO
+
+import boto3
+import polars as pl
+import pytest
+from moto import mock_aws
+
+import query
+
+BUCKET = 'ter-test'
+DATASET = 'UKB_Olink'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    query.clear_footer_cache()
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    query.clear_footer_cache()
+
+
+def make_df(protein, chrom, n=1000, offset=0):
+    return pl.DataFrame({
+        'SNP': [f'rs{i:07d}' for i in range(offset, offset + n)],
+        'chr': [chrom] * n,
+        'pos': [i * 10 for i in range(offset, offset + n)],
+        'effect_allele': ['A'] * n,
+        'other_allele': ['G'] * n,
+        'eaf': [0.5] * n,
+        'beta': [i / n for i in range(n)],
+        'se': [0.1] * n,
+        'pval': [(i % 100) / 100 for i in range(n)],
+        'mlogp': [1.0] * n,
+        'file_name': [protein] * n,
+    }).with_columns(pl.col('chr').cast(pl.Int32))
+
+
+def put_partition(s3_client, df, protein, chrom, row_group_size=100):
+    buffer = BytesIO()
+    df.write_parquet(buffer, row_group_size=row_group_size)
+    s3_client.put_object(Bucket=BUCKET, Key=f'TER/{DATASET}/chr{chrom}/{protein}.parquet', Body=buffer.getvalue())
+
+
+@pytest.fixture
+def populated(s3_client):
+    frames = {}
+    for protein in ['a', 'b', 'c']:
+        for chrom in [1, 2]:
+            df = make_df(protein, chrom)
+            put_partition(s3_client, df, protein, chrom)
+            frames[(protein, chrom)] = df
+    return frames
+
+
+def scan(s3_client, **kwargs):
+    return query.scan_ter(DATASET, s3_client=s3_client, bucket_name=BUCKET, **kwargs)
+
+
+def record_requests(s3_client):
+    calls = {'get_object': [], 'list': []}
+    get_object = s3_client.get_object
+    get_paginator = s3_client.get_paginator
+    list_objects_v2 = s3_client.list_objects_v2
+    s3_client.get_object = lambda **kwargs: calls['get_object'].append(kwargs) or get_object(**kwargs)
+    s3_client.get_paginator = lambda name: calls['list'].append(name) or get_paginator(name)
+    s3_client.list_objects_v2 = lambda **kwargs: calls['list'].append(kwargs) or list_objects_v2(**kwargs)
+    return calls
+
+
+def footer_gets(calls):
+    return [c for c in calls['get_object'] if c['Range'].startswith('bytes=-')]
+
+
+def sort(df):
+    return df.sort(['file_name', 'chr', 'pos'])
+
+
+def test_region_filter(s3_client, populated):
+    result = scan(s3_client, chrom=1, start=2000, end=2500).collect()
+    expected = pl.concat([populated[(p, 1)] for p in 'abc']).filter(pl.col('pos').is_between(2000, 2500))
+    assert result.height == 3 * 51
+    assert sort(result).equals(sort(expected))
+
+
+def test_snp_pval_and_protein_filter(s3_client, populated):
+    snps = ['rs0000005', 'rs0000150', 'rs0000999']
+    result = scan(s3_client, snps=snps, proteins=['b'], pval_threshold=0.1).collect()
+    expected = (
+        pl.concat([populated[('b', 1)], populated[('b', 2)]])
+        .filter(pl.col('SNP').is_in(snps) & (pl.col('pval') < 0.1))
+    )
+    assert set(result['file_name']) == {'b'}
+    assert sort(result).equals(sort(expected))
+
+
+def test_columns_and_lazy_projection(s3_client, populated):
+    lf = scan(s3_client, chrom=2, start=0, end=90, columns=['SNP', 'pos', 'beta', 'file_name'])
+    assert lf.collect_schema().names() == ['SNP', 'pos', 'beta', 'file_name']
+    result = lf.filter(pl.col('file_name') == 'c').select('SNP').collect()
+    assert result['SNP'].to_list() == [f'rs{i:07d}' for i in range(10)]
+
+
+def test_scan_is_lazy(s3_client, populated):
+    calls = record_requests(s3_client)
+    lf = scan(s3_client, chrom=1, start=0, end=10)
+    assert calls == {'get_object': [], 'list': []}
+    assert lf.collect().height == 3 * 2
+    assert calls['list'] and calls['get_object']
+
+
+def test_collect_lists_again(s3_client, populated):
+    lf = scan(s3_client, chrom=1, start=0, end=10)
+    assert lf.collect().height == 3 * 2
+    put_partition(s3_client, make_df('d', 1), 'd', 1)
+    assert set(lf.collect()['file_name']) == {'a', 'b', 'c', 'd'}
+
+
+def test_missing_and_empty_objects_are_skipped(s3_client, populated):
+    s3_client.put_object(Bucket=BUCKET, Key=f'TER/{DATASET}/chr1/empty.parquet', Body=b'')
+    result = scan(s3_client, chrom=1, start=0, end=10, proteins=['missing', 'empty', 'a']).collect()
+    assert set(result['file_name']) == {'a'}
+    # the empty object is also picked up by listing the chromosome prefix
+    assert scan(s3_client, chrom=1, start=0, end=10).collect().height == 3 * 2
+
+
+def test_empty_result_keeps_schema(s3_client, populated):
+    result = scan(s3_client, chrom=1, start=10**9, columns=['pos', 'pval']).collect()
+    assert result.height == 0
+    assert result.schema == pl.Schema({'pos': pl.Int64, 'pval': pl.Float64})
+    assert scan(s3_client, chrom=1, start=10**9).collect().schema == populated[('a', 1)].schema
+    # no objects at all falls back to an empty schema
+    assert scan(s3_client, chrom=1, proteins=['missing']).collect().width == 0
+
+
+def test_rewritten_object_after_cached_footer(s3_client, populated):
+    assert scan(s3_client, chrom=1, proteins=['a'], start=0, end=10).collect().height == 2
+    # re-ingesting rewrites the partition with different row groups and rows
+    put_partition(s3_client, make_df('a', 1, n=5000, offset=0), 'a', 1, row_group_size=1000)
+    result = scan(s3_client, chrom=1, proteins=['a'], start=20000, end=20050).collect()
+    assert result['pos'].to_list() == [20000, 20010, 20020, 20030, 20040, 20050]
+    # a rewrite that the listed etag catches before any data is read
+    put_partition(s3_client, make_df('a', 1, n=6000, offset=0), 'a', 1, row_group_size=1000)
+    result = scan(s3_client, chrom=1, start=55000, end=55010).collect()
+    assert result['pos'].to_list() == [55000, 55010]
+    # data range GETs are pinned to the cached footer's etag
+    put_partition(s3_client, make_df('a', 1, n=7000, offset=0), 'a', 1, row_group_size=3000)
+    result = scan(s3_client, chrom=1, proteins=['a'], start=0, end=10).collect()
+    assert result['pos'].to_list() == [0, 10]
+
+
+def test_footer_cache_is_bounded(s3_client, populated, monkeypatch):
+    footer, _ = query.get_footer(s3_client, BUCKET, f'TER/{DATASET}/chr1/a.parquet')
+    monkeypatch.setattr(query, 'FOOTER_CACHE_BYTES', 2 * footer[2].serialized_size)
+    scan(s3_client, start=0, end=10).collect()
+    assert len(query._footer_cache) == 2
+    assert query._footer_cache_bytes <= query.FOOTER_CACHE_BYTES
+
+
+def test_default_footer_cache_holds_a_chromosome_partition(s3_client):
+    # the largest chromosome of the largest ingested dataset, with polars' default row groups
+    with open('manifest/decode_protein_manifest.csv') as f:
+        n_proteins = sum(1 for _ in f) - 1
+    put_partition(s3_client, make_df('a', 1, n=100_000), 'a', 1, row_group_size=10_000)
+    footer, _ = query.get_footer(s3_client, BUCKET, f'TER/{DATASET}/chr1/a.parquet')
+    assert n_proteins * footer[2].serialized_size < query.FOOTER_CACHE_BYTES
+
+
+def test_region_lookup_requests(s3_client):
+    proteins = [f'protein_{i:03d}' for i in range(100)]
+    for protein in proteins:
+        put_partition(s3_client, make_df(protein, 1, n=10_000), protein, 1, row_group_size=1000)
+    object_size = s3_client.head_object(Bucket=BUCKET, Key=f'TER/{DATASET}/chr1/protein_000.parquet')['ContentLength']
+    assert object_size > query.FOOTER_PREFETCH
+
+    calls = record_requests(s3_client)
+    lf = scan(s3_client, chrom=1, start=5000, end=5100, columns=['SNP', 'pos', 'pval', 'file_name'])
+    assert lf.collect().height == len(proteins) * 11
+    # one footer GET and one GET for the matching row group per object, never a whole object
+    assert all('Range' in c for c in calls['get_object'])
+    assert len(footer_gets(calls)) == len(proteins)
+    assert len(calls['get_object']) == 2 * len(proteins)
+    for c in calls['get_object']:
+        if not c['Range'].startswith('bytes=-'):
+            first, last = map(int, c['Range'][len('bytes='):].split('-'))
+            assert last - first < object_size // 5
+            assert 'IfMatch' in c
+
+    # a repeat query is served from cached footers
+    calls['get_object'].clear()
+    assert lf.collect().height == len(proteins) * 11
+    assert footer_gets(calls) == []
+    assert len(calls['get_object']) == len(proteins)